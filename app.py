@@ -1,9 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import folium
 from streamlit_folium import st_folium
 import pydeck as pdk
+import pandas as pd
 import geopandas as gpd
-from utils import fetch_osm_data, create_risk_zones, perform_spatial_analysis
+import shapely
+from utils import fetch_osm_data, create_risk_zones, perform_spatial_analysis, fill_names, gdf_key, simplify_for_display
 
 # --- CONFIGURATION ---
 st.set_page_config(
@@ -48,13 +52,44 @@ with st.sidebar:
         "in Pokhara using OpenStreetMap data."
     )
 
+# At this many points or more, Leaflet markers bog down the browser and the
+# 2D map is drawn with pydeck on the GPU instead
+FOLIUM_MARKER_LIMIT = 500
+
+# Decimals kept in pydeck coordinates (~11 cm) to keep the JSON sent to
+# deck.gl short
+COORD_DECIMALS = 6
+
+# Risk zone colors (RGB) keyed by risk_type, shared by the folium and pydeck maps
+DEFAULT_RISK_COLOR = [255, 165, 0]
+RISK_COLORS = {
+    "Flood Risk Zone": [255, 0, 0],
+    "Landslide Risk Zone": DEFAULT_RISK_COLOR,
+}
+
+def _folium_risk_style(rgb):
+    """
+    Folium style for a risk zone polygon of the given RGB color.
+    """
+    color = "#{:02x}{:02x}{:02x}".format(*rgb)
+    return {"fillColor": color, "color": color, "weight": 2, "fillOpacity": 0.3}
+
+# Folium styles for the risk zone polygons, keyed by risk_type
+DEFAULT_RISK_STYLE = _folium_risk_style(DEFAULT_RISK_COLOR)
+RISK_STYLES = {risk_type: _folium_risk_style(rgb) for risk_type, rgb in RISK_COLORS.items()}
+
 # --- MAIN DATA FETCHING ---
 place_name = "Pokhara, Nepal"
 waste_tags = {"amenity": ["waste_basket", "recycling", "waste_transfer_station"]}
 
 with st.spinner(f"Fetching latest data for {place_name}..."):
-    waste_gdf = fetch_osm_data(place_name, waste_tags)
-    risk_gdf = create_risk_zones()
+    # Overlap the OSM download with the risk zone construction; worker
+    # threads need the script context for st.cache_* and st.error
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        waste_future = executor.submit(fetch_osm_data, place_name, waste_tags)
+        risk_future = executor.submit(create_risk_zones)
+        waste_gdf, risk_gdf = waste_future.result(), risk_future.result()
 
 # Analysis
 risk_waste = perform_spatial_analysis(waste_gdf, risk_gdf)
@@ -72,130 +107,197 @@ with col2:
 with col3:
     st.metric(label="Points in Risk Areas", value=len(risk_waste), delta=f"{len(risk_waste)/len(waste_gdf)*100:.1f}% of total" if len(waste_gdf)>0 else "0%")
 
-# --- TABS ---
-tab1, tab2, tab3, tab4 = st.tabs(["🗺️ 2D Interactive Map", "🏙️ 3D Visualization", "📊 Risk Analysis", "📢 Report Issue"])
+# Lighter risk outlines for the maps; the analysis above keeps full resolution
+risk_display_gdf = simplify_for_display(risk_gdf)
 
-# --- TAB 1: 2D MAP ---
-with tab1:
-    st.subheader("City Overview")
-    
+# --- PYDECK DATA ---
+# Shared by the 3D view and the GPU fallback of the 2D map. Only the
+# columns pydeck draws are built, so the geometry column is never copied.
+if not waste_gdf.empty:
+    waste_xy = shapely.get_coordinates(waste_gdf.geometry.values).round(COORD_DECIMALS)
+    waste_3d = pd.DataFrame({
+        "lon": waste_xy[:, 0],
+        "lat": waste_xy[:, 1],
+        "amenity": waste_gdf["amenity"].to_numpy()
+    })
+else:
+    waste_3d = pd.DataFrame(columns=["lon", "lat", "amenity"])
+
+# Polygon outlines for risk zones
+risk_records = [
+    {
+        "coordinates": shapely.get_coordinates(geom.exterior).round(COORD_DECIMALS).tolist(),
+        "risk_type": risk_type,
+        "color": RISK_COLORS.get(risk_type, DEFAULT_RISK_COLOR)
+    }
+    for geom, risk_type in zip(risk_display_gdf.geometry, risk_display_gdf["risk_type"])
+]
+
+# --- MAP BUILDERS ---
+def build_folium_map(show_waste, show_risk, waste_gdf, risk_gdf):
+    """
+    Builds the 2D Leaflet map with waste markers and risk zone polygons.
+    Not cached: st_folium renames and re-renders the Map it is given, so a
+    shared Map emits broken Leaflet JS on later reruns.
+    """
     # Base map
     m = folium.Map(location=[28.2096, 83.9856], zoom_start=13, tiles="CartoDB positron")
     
     # Waste Layer
-    if layer_waste and not waste_gdf.empty:
+    if show_waste and not waste_gdf.empty:
         waste_fg = folium.FeatureGroup(name="Waste & Recycling")
-        for idx, row in waste_gdf.iterrows():
-            # Get geometry coordinates
-            lat = row.geometry.y
-            lon = row.geometry.x
-            
-            # Popup content
-            popup_html = f"<b>Type:</b> {row['amenity']}<br>"
-            if 'name' in row and str(row['name']) != 'nan':
-                 popup_html += f"<b>Name:</b> {row['name']}"
-            
-            folium.Marker(
-                location=[lat, lon],
-                popup=folium.Popup(popup_html, max_width=200),
-                icon=folium.Icon(color="green", icon="recycle", prefix="fa"),
-                tooltip="Waste/Recycling Point"
-            ).add_to(waste_fg)
+        # Popup content
+        popup_gdf = waste_gdf[["amenity", "geometry"]].copy()
+        popup_gdf["popup_name"] = fill_names(waste_gdf)
+
+        folium.GeoJson(
+            popup_gdf,
+            marker=folium.Marker(icon=folium.Icon(color="green", icon="recycle", prefix="fa")),
+            popup=folium.GeoJsonPopup(fields=["amenity", "popup_name"], aliases=["Type:", "Name:"], max_width=200),
+            tooltip=folium.GeoJsonTooltip(fields=["amenity"], aliases=["Waste/Recycling Point:"])
+        ).add_to(waste_fg)
         waste_fg.add_to(m)
 
     # Risk Layer
-    if layer_risk and not risk_gdf.empty:
+    if show_risk and not risk_gdf.empty:
         risk_fg = folium.FeatureGroup(name="Risk Zones")
-        for idx, row in risk_gdf.iterrows():
-            color = "red" if "Flood" in row["risk_type"] else "orange"
-            folium.GeoJson(
-                row.geometry,
-                style_function=lambda x, color=color: {
-                    "fillColor": color,
-                    "color": color,
-                    "weight": 2,
-                    "fillOpacity": 0.3
-                },
-                tooltip=f"⚠ {row['risk_type']}"
-            ).add_to(risk_fg)
+        # Tooltip content
+        tooltip_gdf = risk_gdf[["risk_type", "geometry"]].copy()
+        tooltip_gdf["tooltip"] = "⚠ " + tooltip_gdf["risk_type"]
+
+        folium.GeoJson(
+            tooltip_gdf,
+            style_function=lambda feature: RISK_STYLES.get(feature["properties"]["risk_type"], DEFAULT_RISK_STYLE),
+            tooltip=folium.GeoJsonTooltip(fields=["tooltip"], labels=False)
+        ).add_to(risk_fg)
         risk_fg.add_to(m)
 
     folium.LayerControl().add_to(m)
-    st_folium(m, width="100%", height=500)
+    return m
 
-# --- TAB 2: 3D VISUALIZATION ---
-with tab2:
-    st.subheader("3D Terrain & Density View")
+# Decks are cached per layer toggle combination. Underscored arguments are
+# not hashed by Streamlit; data_key identifies the data instead.
+@st.cache_resource(show_spinner=False)
+def build_point_deck(show_waste, show_risk, data_key, _waste_3d, _risk_records):
+    """
+    Builds the 2D WebGL map used when there are too many points for Leaflet.
+    """
+    layers = []
     
-    if not waste_gdf.empty and not risk_gdf.empty:
-        # Prepare data for PyDeck
-        waste_3d = waste_gdf.copy()
-        waste_3d["lat"] = waste_3d.geometry.y
-        waste_3d["lon"] = waste_3d.geometry.x
-        
-        # Centroids for risk zones
-        risk_3d = risk_gdf.copy()
-        risk_3d["lat"] = risk_3d.geometry.centroid.y
-        risk_3d["lon"] = risk_3d.geometry.centroid.x
-        
-        # Layers
-        layers = []
-        
-        # Satellite Basemap Layer (Esri World Imagery)
-        satellite_layer = pdk.Layer(
-            "TileLayer",
-            data=["https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"],
-            min_zoom=0,
-            max_zoom=19,
-            tile_size=256,
+    if show_waste:
+        point_layer = pdk.Layer(
+            "ScatterplotLayer",
+            data=_waste_3d,
+            get_position=["lon", "lat"],
+            get_fill_color=[0, 200, 80, 200],
+            get_radius=30,
+            pickable=True,
         )
-        layers.append(satellite_layer)
+        layers.append(point_layer)
         
-        if layer_waste:
-            waste_layer = pdk.Layer(
-                "ColumnLayer",
-                data=waste_3d,
-                get_position=["lon", "lat"],
-                get_elevation=50,
-                elevation_scale=10,
-                radius=30,
-                get_fill_color=[0, 255, 100, 200], # Neon Green for contrast
-                pickable=True,
-                auto_highlight=True,
-            )
-            layers.append(waste_layer)
-            
-        if layer_risk:
-            # Using Scatterplot for zones in 3D (simplified representation)
-            risk_layer = pdk.Layer(
-                "ScatterplotLayer",
-                data=risk_3d,
-                get_position=["lon", "lat"],
-                get_radius=1000,
-                get_fill_color=[255, 50, 50, 100],
-                stroked=True,
-                get_line_color=[255, 0, 0, 200],
-                get_line_width=20,
-                pickable=True,
-            )
-            layers.append(risk_layer)
-
-        # Deck
-        view_state = pdk.ViewState(
-            latitude=28.2096,
-            longitude=83.9856,
-            zoom=12,
-            pitch=50,
+    if show_risk:
+        risk_layer = pdk.Layer(
+            "PolygonLayer",
+            data=_risk_records,
+            get_polygon="coordinates",
+            get_fill_color="color",
+            get_line_color="color",
+            line_width_min_pixels=2,
+            opacity=0.3,
         )
-        
-        r = pdk.Deck(
-            layers=layers,
-            initial_view_state=view_state,
-            tooltip={"text": "Feature Location"},
-            map_style="https://basemaps.cartocdn.com/gl/dark-matter-gl-style/style.json"
+        layers.append(risk_layer)
+    
+    return pdk.Deck(
+        layers=layers,
+        initial_view_state=pdk.ViewState(latitude=28.2096, longitude=83.9856, zoom=13),
+        tooltip={"text": "Waste/Recycling Point: {amenity}"},
+        map_style="https://basemaps.cartocdn.com/gl/positron-gl-style/style.json"
+    )
+
+@st.cache_resource(show_spinner=False)
+def build_3d_deck(show_waste, show_risk, data_key, _waste_3d, _risk_records):
+    """
+    Builds the 3D satellite view with extruded waste points and risk zones.
+    """
+    # Layers
+    layers = []
+    
+    # Satellite Basemap Layer (Esri World Imagery)
+    satellite_layer = pdk.Layer(
+        "TileLayer",
+        data=["https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"],
+        min_zoom=0,
+        max_zoom=19,
+        tile_size=256,
+    )
+    layers.append(satellite_layer)
+    
+    if show_waste:
+        waste_layer = pdk.Layer(
+            "ColumnLayer",
+            data=_waste_3d,
+            get_position=["lon", "lat"],
+            get_elevation=50,
+            elevation_scale=10,
+            radius=30,
+            get_fill_color=[0, 255, 100, 200], # Neon Green for contrast
+            pickable=True,
+            auto_highlight=True,
         )
+        layers.append(waste_layer)
         
-        st.pydeck_chart(r)
+    if show_risk:
+        risk_layer = pdk.Layer(
+            "PolygonLayer",
+            data=_risk_records,
+            get_polygon="coordinates",
+            get_fill_color=[255, 50, 50, 100],
+            stroked=True,
+            get_line_color=[255, 0, 0, 200],
+            line_width_min_pixels=2,
+            pickable=True,
+        )
+        layers.append(risk_layer)
+
+    # Deck
+    view_state = pdk.ViewState(
+        latitude=28.2096,
+        longitude=83.9856,
+        zoom=12,
+        pitch=50,
+    )
+    
+    return pdk.Deck(
+        layers=layers,
+        initial_view_state=view_state,
+        tooltip={"text": "Feature Location"},
+        map_style="https://basemaps.cartocdn.com/gl/dark-matter-gl-style/style.json"
+    )
+
+# Stable across reruns, unlike id() of the frames st.cache_data hands back
+data_key = (gdf_key(waste_gdf), gdf_key(risk_gdf))
+
+# --- TABS ---
+tab1, tab2, tab3, tab4 = st.tabs(["🗺️ 2D Interactive Map", "🏙️ 3D Visualization", "📊 Risk Analysis", "📢 Report Issue"])
+
+# --- TAB 1: 2D MAP ---
+with tab1:
+    st.subheader("City Overview")
+    
+    if len(waste_gdf) < FOLIUM_MARKER_LIMIT:
+        m = build_folium_map(layer_waste, layer_risk, waste_gdf, risk_display_gdf)
+        # The map state is never read back, so don't rerun the app on pan/zoom
+        st_folium(m, width="100%", height=500, returned_objects=[])
+    else:
+        # Too many markers for Leaflet; draw everything in one WebGL pass
+        st.pydeck_chart(build_point_deck(layer_waste, layer_risk, data_key, waste_3d, risk_records))
+
+# --- TAB 2: 3D VISUALIZATION ---
+with tab2:
+    st.subheader("3D Terrain & Density View")
+    
+    if not waste_gdf.empty and not risk_gdf.empty:
+        st.pydeck_chart(build_3d_deck(layer_waste, layer_risk, data_key, waste_3d, risk_records))
     else:
         st.warning("No data available for 3D view.")
 
@@ -208,10 +310,7 @@ with tab3:
         # Clean up table for display
         display_cols = ['amenity', 'risk_type', 'name']
         # Add name if missing
-        if 'name' not in risk_waste.columns:
-            risk_waste['name'] = "Unknown"
-        else:
-             risk_waste['name'] = risk_waste['name'].fillna("Unknown")
+        risk_waste['name'] = fill_names(risk_waste)
              
         cols_to_show = [c for c in display_cols if c in risk_waste.columns]
         
@@ -222,10 +321,10 @@ with tab3:
         st.success("Analysis complete: No waste resources found in the currently defined high-risk zones.")
 
 # --- TAB 4: REPORT ISSUE ---
-with tab4:
-    st.subheader("Citizen Reporting Prototype")
-    st.markdown("Report unmanaged waste or new hazard zones.")
-    
+# A fragment, so submitting a report reruns only the form and not the
+# data loading and maps above
+@st.fragment
+def render_report_form():
     with st.form("report_form"):
         report_type = st.selectbox("Issue Type", ["Unmanaged Waste", "Landslide Risk", "Flood Prone Area", "Other"])
         description = st.text_area("Description", placeholder="Describe the issue...")
@@ -237,6 +336,12 @@ with tab4:
             st.success("✅ Report submitted successfully! This data would be sent to the backend database in a production environment.")
             st.balloons()
 
+with tab4:
+    st.subheader("Citizen Reporting Prototype")
+    st.markdown("Report unmanaged waste or new hazard zones.")
+    
+    render_report_form()
+
 
 
 
@@ -1,31 +1,84 @@
+import hashlib
+import json
+from pathlib import Path
 import streamlit as st
 import osmnx as ox
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import Point
+from pyproj import Transformer
 import folium
 
+# On-disk GeoParquet cache for OSM pulls, survives server restarts
+CACHE_DIR = Path(__file__).parent / ".cache"
+
+def _osm_cache_path(place_name, tags):
+    """
+    Stable cache file path for an OSM query.
+    """
+    query = json.dumps([place_name, tags], sort_keys=True)
+    return CACHE_DIR / f"{hashlib.sha1(query.encode()).hexdigest()}.parquet"
+
+# WGS84 <-> UTM 45N transformers, built once instead of on every to_crs
+_WGS84_TO_UTM = Transformer.from_crs(4326, 32645, always_xy=True)
+_UTM_TO_WGS84 = Transformer.from_crs(32645, 4326, always_xy=True)
+
+def _reproject(transformer):
+    """
+    Wraps a pyproj Transformer as a coordinate function for shapely.transform.
+    """
+    return lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1]))
+
+def gdf_key(gdf):
+    """
+    Cheap hash key for a GeoDataFrame (row count and bounds).
+    """
+    if gdf.empty:
+        return (0,)
+    return (len(gdf), tuple(gdf.total_bounds))
+
 @st.cache_data
 def fetch_osm_data(place_name, tags):
     """
     Fetches POIs from OpenStreetMap based on tags.
-    Cached by Streamlit to avoid re-downloading on every rerun.
+    Cached by Streamlit to avoid re-downloading on every rerun, and on
+    disk as GeoParquet to avoid re-downloading after a restart.
     """
+    cache_path = _osm_cache_path(place_name, tags)
+    if cache_path.exists():
+        try:
+            return gpd.read_parquet(cache_path)
+        except (OSError, ValueError):
+            pass  # Unreadable cache file, fetch again
+    
     try:
         gdf = ox.features_from_place(place_name, tags)
         # Keep only points
         if not gdf.empty:
-             gdf = gdf[gdf.geometry.type == 'Point']
+             gdf = gdf[shapely.get_type_id(gdf.geometry.values) == shapely.GeometryType.POINT]
              # Ensure CRS is 4326 for plotting
              if gdf.crs != "EPSG:4326":
                  gdf = gdf.to_crs(epsg=4326)
+             # Persist for the next server start
+             try:
+                 CACHE_DIR.mkdir(exist_ok=True)
+                 gdf.to_parquet(cache_path)
+             except (OSError, ValueError, TypeError):
+                 pass  # Read-only disk or columns Arrow cannot encode; skip the disk cache
         return gdf
     except Exception as e:
         st.error(f"Error fetching OSM data: {e}")
         return gpd.GeoDataFrame()
 
+@st.cache_resource(show_spinner=False)
 def create_risk_zones():
     """
     Creates hypothetical disaster risk zones.
+    Inputs are constant, so the reprojection and buffering run once.
+    Cached as a shared resource (not pickled) so the prepared polygons
+    are reused by every spatial join.
     """
     # Define disaster-prone points (approximate locations in Pokhara)
     # Seti River Gorge area (Flood Risk)
@@ -33,34 +86,58 @@ def create_risk_zones():
     # Sarangkot Slope area (Landslide Risk)
     landslide_center = Point(83.954, 28.243)
     
-    # Create GeoDataFrame
+    centers = np.array([flood_center, landslide_center])
+    
+    # Project to UTM 45N for accurate buffering in meters
+    centers_utm = shapely.transform(centers, _reproject(_WGS84_TO_UTM))
+    
+    # Create buffer zones (1.2km for flood, 1km for landslide). quad_segs=16
+    # matches GeoSeries.buffer's default resolution, which the analysis uses
+    radii = np.array([1200.0, 1000.0])
+    zones_utm = shapely.buffer(centers_utm, radii, quad_segs=16)
+    
+    # Create GeoDataFrame, projected back to WGS84
     disaster_gdf = gpd.GeoDataFrame(
         {
             "risk_type": ["Flood Risk Zone", "Landslide Risk Zone"],
             "severity": ["High", "High"]
         },
-        geometry=[flood_center, landslide_center],
+        geometry=shapely.transform(zones_utm, _reproject(_UTM_TO_WGS84)),
         crs="EPSG:4326"
     )
     
-    # Reproject to projected CRS (UTM 45N) for accurate buffering in meters
-    disaster_gdf = disaster_gdf.to_crs(epsg=32645)
-    
-    # Create buffer zones (1.2km for flood, 1km for landslide)
-    disaster_gdf["geometry"] = disaster_gdf.geometry.buffer([1200, 1000])
-    
-    # Reproject back to WGS84
-    disaster_gdf = disaster_gdf.to_crs(epsg=4326)
+    # Prepare polygons in place for fast repeated point-in-polygon tests
+    shapely.prepare(disaster_gdf.geometry.values)
     
     return disaster_gdf
 
+def simplify_for_display(gdf, tolerance=0.0002):
+    """
+    Returns a copy of gdf with outlines simplified for map display.
+    The tolerance is in degrees; 0.0002 keeps every simplified outline
+    within about 20 m of the original. Analysis should keep using the
+    original frame.
+    """
+    return gdf.set_geometry(shapely.simplify(gdf.geometry.values, tolerance), crs=gdf.crs)
+
+def fill_names(gdf, default="Unknown"):
+    """
+    Returns the OSM name column with missing names filled in.
+    """
+    if "name" in gdf.columns:
+        return gdf["name"].fillna(default)
+    return pd.Series(default, index=gdf.index)
+
+@st.cache_data(show_spinner=False, hash_funcs={gpd.GeoDataFrame: gdf_key})
 def perform_spatial_analysis(waste_gdf, risk_gdf):
     """
     Finds which waste points fall inside risk zones.
+    Cached on the size and bounds of both frames.
     """
     if waste_gdf.empty or risk_gdf.empty:
         return gpd.GeoDataFrame()
         
-    # Spatial join
-    joined = gpd.sjoin(waste_gdf, risk_gdf, how="inner", predicate="intersects")
+    # Spatial join; geopandas runs "within" as the prepared risk polygons
+    # querying a tree of the waste points with "contains"
+    joined = gpd.sjoin(waste_gdf, risk_gdf, how="inner", predicate="within")
     return joined